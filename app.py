@@ -1,12 +1,15 @@
 import streamlit as st
-import pandas as pd
 from PIL import Image, ImageFile
 from datetime import datetime
 import json
+import logging
 import os
 from pathlib import Path
-import time
-import base64
+import binascii
+from collections import deque
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -19,7 +22,9 @@ FOOD_IMG_DIR = ASSETS_DIR / "foods"
 
 DATA_DIR = Path("food_data")
 IMAGES_DIR = DATA_DIR / "images"
-DATASET_FILE = DATA_DIR / "dataset.json"
+DATASET_FILE = DATA_DIR / "dataset.jsonl"
+MAX_HISTORY = 10000  # newest predictions kept in session state
+LEGACY_DATASET_FILE = DATA_DIR / "dataset.json"
 DATA_DIR.mkdir(exist_ok=True)
 IMAGES_DIR.mkdir(exist_ok=True)
 
@@ -60,7 +65,6 @@ def set_qp(**kwargs):
 # -----------------------------------------------------------------------------
 # Base64 helper
 # -----------------------------------------------------------------------------
-@st.cache_data(show_spinner=False)
 def img_to_data_uri(path_str: str) -> str | None:
     path = Path(path_str)
     if not path.exists():
@@ -72,64 +76,276 @@ def img_to_data_uri(path_str: str) -> str | None:
     mime = f"image/{ext}" if ext in ["png", "jpeg", "webp"] else "image/png"
 
     try:
-        b64 = base64.b64encode(path.read_bytes()).decode("utf-8")
+        b64 = binascii.b2a_base64(path.read_bytes(), newline=False).decode("ascii")
         return f"data:{mime};base64,{b64}"
     except Exception:
         return None
 
 # -----------------------------------------------------------------------------
-# YOLO import
+# YOLO model
 # -----------------------------------------------------------------------------
-try:
+# ultralytics (and torch) are imported on first use, so the first page
+# paints without waiting for them.
+MODEL_PATH = "best_model.pt"
+FP16_ENGINE_PATH = "best_model_fp16.engine"
+INT8_ENGINE_PATH = "best_model_int8.engine"
+ONNX_PATH = "best_model_cpu.onnx"
+MODEL_IMGSZ = 224  # matches the imgsz best_model.pt was trained with
+BATCH_MAX_SIZE = 8
+INFER_TIMEOUT_S = 120  # per request; a first-start export can take longer, see render_analysis_view
+INFER_MAX_SIDE = 640  # uploads are shrunk toward this before predict (see classify_image)
+
+# INT8 calibrates on a classify dataset with split folders, e.g.
+# calib_data/train/<class>/... and calib_data/val/<class>/... (classes
+# Clean / Partially_Eaten / Uneaten); ultralytics calibrates on val/, so
+# put the ~500 calibration images there. Set ENGINE_INT8 = False for
+# accuracy-sensitive deploys to keep the FP16 engine.
+ENGINE_INT8 = True
+CALIB_DATA_DIR = Path("calib_data")
+
+logger = logging.getLogger(__name__)
+
+def calib_data_ready() -> bool:
+    return (CALIB_DATA_DIR / "train").is_dir() and (CALIB_DATA_DIR / "val").is_dir()
+
+def cuda_available() -> bool:
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        return False
+
+def export_model(fmt: str, target_path: str, **kwargs) -> str:
+    # ultralytics writes best_model.<ext> in place; moving it to its own name
+    # only once export() returns means an interrupted export never leaves a
+    # partial file at target_path. A best_model.pt newer than the export
+    # (retrained or replaced) triggers a fresh export.
+    stale = (
+        not os.path.exists(target_path)
+        or os.path.getmtime(target_path) < os.path.getmtime(MODEL_PATH)
+    )
+    if stale:
+        from ultralytics import YOLO
+        exported = YOLO(MODEL_PATH).export(
+            format=fmt, imgsz=MODEL_IMGSZ, dynamic=True, **kwargs,
+        )
+        os.replace(exported, target_path)
+    return target_path
+
+def checked_model(path: str):
+    # .onnx/.engine files are only opened by the first predict, so run one
+    # here; a truncated or incompatible file raises now instead of on every
+    # user request
     from ultralytics import YOLO
-    YOLO_AVAILABLE = True
-except ImportError:
-    YOLO_AVAILABLE = False
+    model = YOLO(path, task="classify")
+    warmup = Image.new("RGB", (MODEL_IMGSZ, MODEL_IMGSZ))
+    model.predict(source=warmup, verbose=False, imgsz=MODEL_IMGSZ)
+    return model
 
-@st.cache_resource
+# Called once per process on the InferenceBatcher worker thread (see
+# get_batcher), so exports never block a script thread.
 def load_model():
-    model_path = "best_model.pt"
-    if not YOLO_AVAILABLE:
+    try:
+        from ultralytics import YOLO
+    except ImportError:
         return None
-    if os.path.exists(model_path):
-        return YOLO(model_path)
-    return None
+    if not os.path.exists(MODEL_PATH):
+        return None
+    if cuda_available():
+        # TensorRT engine, exported once and reused on later starts
+        if ENGINE_INT8 and calib_data_ready():
+            try:
+                engine = export_model(
+                    "engine", INT8_ENGINE_PATH, batch=BATCH_MAX_SIZE,
+                    int8=True, data=str(CALIB_DATA_DIR),
+                )
+                return checked_model(engine)
+            except Exception:
+                logger.warning("INT8 engine export failed, using FP16", exc_info=True)
+        elif ENGINE_INT8 and CALIB_DATA_DIR.exists():
+            logger.warning("%s needs train/ and val/ folders for INT8, using FP16", CALIB_DATA_DIR)
+        try:
+            engine = export_model("engine", FP16_ENGINE_PATH, batch=BATCH_MAX_SIZE, half=True)
+            return checked_model(engine)
+        except Exception:
+            logger.warning("FP16 engine export failed, using %s", MODEL_PATH, exc_info=True)
+    else:
+        # CPU only: ONNX Runtime graph, exported once and reused on later starts
+        try:
+            onnx = export_model("onnx", ONNX_PATH, simplify=True)
+            return checked_model(onnx)
+        except Exception:
+            logger.warning("ONNX export failed, using %s", MODEL_PATH, exc_info=True)
+    return YOLO(MODEL_PATH)
 
-MODEL = load_model()
+# -----------------------------------------------------------------------------
+# Inference batching
+# -----------------------------------------------------------------------------
+# One worker thread owns model.predict. Whatever is queued while a batch runs
+# goes into the next one, so a lone request is never held back. The model
+# itself is loaded on the worker too.
+class InferenceBatcher:
+    def __init__(self, loader, max_batch: int = BATCH_MAX_SIZE):
+        self.loader = loader
+        self.model = None
+        self.ready = threading.Event()  # set once loading and warm-up are over
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image: Image.Image) -> Future:
+        if not self.worker.is_alive():
+            raise RuntimeError("inference worker is not running")
+        future = Future()
+        self.queue.put((image, future))
+        return future
+
+    def _run(self):
+        # Load (and on first start, export) the model, then run one predict
+        # to pay for CUDA/cuDNN setup and engine load before any user
+        # request does. Early submits just wait in the queue.
+        try:
+            self.model = self.loader()
+        except Exception:
+            logger.warning("Model load failed", exc_info=True)
+        if self.model is not None:
+            try:
+                warmup = Image.new("RGB", (MODEL_IMGSZ, MODEL_IMGSZ))
+                self.model.predict(source=warmup, verbose=False, imgsz=MODEL_IMGSZ)
+            except Exception:
+                # the loaded backend cannot run; serve the PyTorch weights instead
+                logger.warning("Warm-up predict failed, using %s", MODEL_PATH, exc_info=True)
+                try:
+                    self.model = checked_model(MODEL_PATH)
+                except Exception:
+                    logger.warning("%s cannot run either", MODEL_PATH, exc_info=True)
+                    self.model = None
+        self.ready.set()
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self.model is None:
+                for _, future in batch:
+                    future.set_exception(RuntimeError("model not available"))
+                continue
+
+            images = [img for img, _ in batch]
+            try:
+                results = self.model.predict(source=images, verbose=False, imgsz=MODEL_IMGSZ)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), r in zip(batch, results):
+                future.set_result(r)
+
+@st.cache_resource(show_spinner=False)
+def get_batcher():
+    return InferenceBatcher(load_model)
 
 # -----------------------------------------------------------------------------
 # Dataset helpers
 # -----------------------------------------------------------------------------
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def json_loads(raw: bytes):
+    if ORJSON_AVAILABLE:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def json_line(obj) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+# dataset.jsonl is append-only, one prediction per line, oldest first.
+# In memory the list is newest first to match the UI.
+# mtime/size only key the cache, so a session start re-parses the file
+# only when it has changed since the last parse.
+@st.cache_data(show_spinner=False, max_entries=1)
+def read_dataset(mtime_ns: int, size: int):
+    data = []
+    for line in DATASET_FILE.read_bytes().splitlines():
+        if not line.strip():
+            continue
+        try:
+            data.append(json_loads(line))
+        except ValueError:
+            # a write cut off by a crash leaves a partial line; skip it
+            continue
+    data.reverse()
+    return data
+
 def load_dataset():
-    if DATASET_FILE.exists():
-        with open(DATASET_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    if not DATASET_FILE.exists() and LEGACY_DATASET_FILE.exists():
+        save_dataset(json_loads(LEGACY_DATASET_FILE.read_bytes()))
+    if not DATASET_FILE.exists():
+        return []
+    stat = DATASET_FILE.stat()
+    return read_dataset(stat.st_mtime_ns, stat.st_size)
 
 def save_dataset(data):
-    with open(DATASET_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def save_image(uploaded_file, pred_id: str):
+    DATASET_FILE.write_bytes(b"".join(json_line(p) for p in reversed(data)))
+
+def append_prediction(prediction):
+    with open(DATASET_FILE, "ab+") as f:
+        # start on a fresh line if the last write was cut off mid-line
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write(json_line(prediction))
+
+# Export covers the whole file, not just the capped session history.
+# Keyed like read_dataset, so only the current file state is kept.
+@st.cache_data(show_spinner=False, max_entries=1)
+def dataset_to_csv(mtime_ns: int, size: int) -> str:
+    import pandas as pd
+    df = pd.DataFrame(read_dataset(mtime_ns, size))
+    return df.to_csv(index=False, encoding="utf-8-sig")
+
+def new_history(data=()) -> deque:
+    # data is newest first; slice so the deque keeps the newest, not the oldest
+    return deque(list(data)[:MAX_HISTORY], maxlen=MAX_HISTORY)
+
+def save_image(uploaded_file, image: Image.Image, pred_id: str):
+    # image is the already-decoded RGB upload, reused to avoid a second decode
     img_path = IMAGES_DIR / f"{pred_id}.jpg"
-    Image.open(uploaded_file).convert("RGB").save(img_path)
+    if uploaded_file.type == "image/jpeg":
+        # already a JPEG, keep the uploaded bytes as-is
+        img_path.write_bytes(uploaded_file.getvalue())
+    else:
+        image.save(img_path)
     return str(img_path)
 
 def classify_image(image: Image.Image):
-    if MODEL is None:
-        return "Error", 0.0
+    batcher = get_batcher()
     try:
-        temp_path = "temp_image.jpg"
-        image.convert("RGB").save(temp_path)
-        results = MODEL.predict(source=temp_path, verbose=False)
-        r = results[0]
-        probs = r.probs.data.cpu().numpy()
-        names = r.names
-        top_idx = int(probs.argmax())
-        result = str(names[top_idx])
-        confidence = float(probs[top_idx] * 100.0)
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        # ultralytics resizes the shortest side to MODEL_IMGSZ and centre-crops,
+        # so shrink toward INFER_MAX_SIDE but never take the shortest side
+        # below MODEL_IMGSZ, or wide images would be upsampled afterwards
+        scale = max(MODEL_IMGSZ / min(image.size), INFER_MAX_SIDE / max(image.size))
+        if scale < 1:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        # PIL images go straight in; ultralytics reads raw numpy arrays as BGR
+        r = batcher.submit(image).result(timeout=INFER_TIMEOUT_S)
+        top_idx = int(r.probs.top1)
+        result = str(r.names[top_idx])
+        confidence = float(r.probs.top1conf) * 100.0
         return result, confidence
     except Exception:
         return "Error", 0.0
@@ -153,6 +369,20 @@ DASHBOARD_IMAGES = [
     {"title": "Clean vs. Uneaten Rate by Dish ID", "file": "Clean vs. Uneaten Rate by Dish ID.png"},
 ]
 
+# Static assets are read and encoded once per process, not on every rerun
+@st.cache_resource(show_spinner=False)
+def load_dish_uris() -> dict:
+    return {dish_id: img_to_data_uri(dish["img"]) for dish_id, dish in DISHES.items()}
+
+def read_bytes_or_none(path: Path) -> bytes | None:
+    return path.read_bytes() if path.exists() else None
+
+@st.cache_resource(show_spinner=False)
+def load_dashboard_images() -> list:
+    paths = [DASHBOARD_DIR / item["file"] for item in DASHBOARD_IMAGES]
+    with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+        return list(ex.map(read_bytes_or_none, paths))
+
 # -----------------------------------------------------------------------------
 # Session
 # -----------------------------------------------------------------------------
@@ -161,7 +391,9 @@ if "step" not in st.session_state:
 if "selected_dish" not in st.session_state:
     st.session_state.selected_dish = None
 if "predictions" not in st.session_state:
-    st.session_state.predictions = load_dataset()
+    history = load_dataset()
+    st.session_state.predictions = new_history(history)
+    st.session_state.total_predictions = len(history)
 
 # -----------------------------------------------------------------------------
 # Query param click handler
@@ -179,7 +411,9 @@ if dish_from_qp and dish_from_qp in DISHES:
 # -----------------------------------------------------------------------------
 # CSS (Balanced analysis page + keep theme)
 # -----------------------------------------------------------------------------
-st.markdown("""
+# Streamlit drops any element a rerun does not emit again, so the styles
+# have to go out on every run; they are sent as one constant block.
+APP_CSS = """
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Cairo:wght@400;600;700;800;900&display=swap');
 html, body, [class*="css"] { font-family: "Cairo", sans-serif; }
@@ -363,8 +597,39 @@ button:disabled{
   border: 1px dashed rgba(22,58,42,0.22) !important;
   background: rgba(46,125,50,0.06) !important;
 }
+
+/* Records table (light theme) */
+.records-wrap{ margin-top: 10px; }
+table.records-table{
+  width: 100%;
+  border-collapse: separate;
+  border-spacing: 0;
+  background: #ffffff;
+  border: 1px solid rgba(22,58,42,0.12);
+  border-radius: 14px;
+  overflow: hidden;
+  font-family: "Cairo", sans-serif;
+}
+table.records-table thead th{
+  background: #f2f4f3;
+  color: #163a2a;
+  font-weight: 900;
+  padding: 12px 14px;
+  text-align: left;
+  border-bottom: 1px solid rgba(22,58,42,0.12);
+}
+table.records-table tbody td{
+  background: #ffffff;
+  color: #163a2a;
+  font-weight: 800;
+  padding: 12px 14px;
+  border-bottom: 1px solid rgba(22,58,42,0.08);
+}
+table.records-table tbody tr:nth-child(even) td{ background: #fafbfa; }
+table.records-table tbody tr:last-child td{ border-bottom: none; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # -----------------------------------------------------------------------------
 # Sidebar
@@ -387,7 +652,7 @@ with st.sidebar:
         f"""
         <div class="sb-stat">
             <div class="sb-stat-title">Total Analyses</div>
-            <div class="sb-stat-num">{len(st.session_state.predictions)}</div>
+            <div class="sb-stat-num">{st.session_state.total_predictions}</div>
         </div>
         """,
         unsafe_allow_html=True
@@ -411,10 +676,11 @@ def render_food_selection_home():
     st.markdown("<div class='section-title'>Select Food Type</div>", unsafe_allow_html=True)
     st.markdown("<div class='section-line'></div>", unsafe_allow_html=True)
 
+    dish_uris = load_dish_uris()
     cols = st.columns(4, gap="large")
     for idx, (dish_id, dish) in enumerate(DISHES.items()):
         with cols[idx]:
-            data_uri = img_to_data_uri(dish["img"])
+            data_uri = dish_uris[dish_id]
             if data_uri:
                 st.markdown(f"""
                 <div>
@@ -466,16 +732,17 @@ def render_analysis_view():
             st.rerun()
 
     with a2:
-        if st.session_state.predictions:
-            df = pd.DataFrame(st.session_state.predictions)
-            csv = df.to_csv(index=False, encoding="utf-8-sig")
+        if st.session_state.predictions and DATASET_FILE.exists():
+            stat = DATASET_FILE.stat()
+            csv = dataset_to_csv(stat.st_mtime_ns, stat.st_size)
             st.download_button("Export CSV", csv, "dataset.csv", "text/csv", use_container_width=True)
         else:
             st.button("Export CSV", use_container_width=True, disabled=True)
 
     with a3:
         if st.button("Clear History", use_container_width=True, disabled=not bool(st.session_state.predictions)):
-            st.session_state.predictions = []
+            st.session_state.predictions = new_history()
+            st.session_state.total_predictions = 0
             save_dataset([])
             st.rerun()
 
@@ -503,12 +770,18 @@ def render_analysis_view():
         if uploaded:
             if st.button("Analyze Now", use_container_width=True):
                 with st.spinner("Processing..."):
-                    time.sleep(0.8)
-                    image = Image.open(uploaded)
+                    image = Image.open(uploaded).convert("RGB")
                     result, confidence = classify_image(image)
 
+                # failed or timed-out analyses are reported, not recorded
+                if result == "Error":
+                    if not get_batcher().ready.is_set():
+                        st.warning("The model is still loading. Please try again in a moment.")
+                    else:
+                        st.error("Analysis failed. Please try again.")
+                else:
                     pred_id = f"pred_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                    img_path = save_image(uploaded, pred_id)
+                    img_path = save_image(uploaded, image, pred_id)
 
                     prediction = {
                         "id": pred_id,
@@ -519,11 +792,12 @@ def render_analysis_view():
                         "result": result,
                         "confidence": round(confidence, 2),
                     }
-                    st.session_state.predictions.insert(0, prediction)
-                    save_dataset(st.session_state.predictions)
+                    st.session_state.predictions.appendleft(prediction)
+                    st.session_state.total_predictions += 1
+                    append_prediction(prediction)
 
-                st.success("Done")
-                st.rerun()
+                    st.success("Done")
+                    st.rerun()
         else:
             st.button("Analyze Now", use_container_width=True, disabled=True)
 
@@ -571,12 +845,7 @@ def render_analysis_view():
 def render_dataset_page():
     page_header("Dataset", "Dashboard preview (static images)")
 
-    DASHBOARD_ITEMS = [
-        ("Plate Condition Breakdown by Dish ID", "Plate Condition Breakdown by Dish ID.png"),
-        ("Overall Plate Condition Distribution", "Overall Plate Condition Distribution.png"),
-        ("Uneaten Plate Rate by Meal Category", "Uneaten Plate Rate by Meal Category.png"),
-        ("Clean vs. Uneaten Rate by Dish ID", "Clean vs. Uneaten Rate by Dish ID.png"),
-    ]
+    dashboard_blobs = load_dashboard_images()
 
     st.markdown("<div style='height:12px'></div>", unsafe_allow_html=True)
 
@@ -585,8 +854,8 @@ def render_dataset_page():
 
     for r in rows:
         for col in r:
-            title, filename = DASHBOARD_ITEMS[idx]
-            img_path = DASHBOARD_DIR / filename
+            title, filename = DASHBOARD_IMAGES[idx]["title"], DASHBOARD_IMAGES[idx]["file"]
+            blob = dashboard_blobs[idx]
 
             with col:
                 st.markdown(
@@ -605,8 +874,8 @@ def render_dataset_page():
                     unsafe_allow_html=True
                 )
 
-                if img_path.exists():
-                    st.image(str(img_path), use_container_width=True)
+                if blob is not None:
+                    st.image(blob, use_container_width=True)
                 else:
                     st.warning(f"Missing image: {filename}")
 
@@ -626,67 +895,14 @@ def render_dataset_page():
         st.info("No data yet. Start by analyzing images from the Home page.")
         return
 
-
-    df = pd.DataFrame(st.session_state.predictions)
+    import pandas as pd
+    df = pd.DataFrame(list(st.session_state.predictions))
     view = df[["date", "time", "dish", "result", "confidence"]]
 
-    # ✅ Table CSS (light theme)
-    st.markdown("""
-    <style>
-    /* records table wrapper */
-    .records-wrap { margin-top: 10px; }
-
-    /* the actual table */
-    table.records-table{
-    width: 100%;
-    border-collapse: separate;
-    border-spacing: 0;
-    background: #ffffff;
-    border: 1px solid rgba(22,58,42,0.12);
-    border-radius: 14px;
-    overflow: hidden;
-    font-family: "Cairo", sans-serif;
-    }
-
-    /* header */
-    table.records-table thead th{
-    background: #f2f4f3;
-    color: #163a2a;
-    font-weight: 900;
-    padding: 12px 14px;
-    text-align: left;
-    border-bottom: 1px solid rgba(22,58,42,0.12);
-    }
-
-    /* body cells */
-    table.records-table tbody td{
-    background: #ffffff;
-    color: #163a2a;
-    font-weight: 800;
-    padding: 12px 14px;
-    border-bottom: 1px solid rgba(22,58,42,0.08);
-    }
-
-    /* zebra rows */
-    table.records-table tbody tr:nth-child(even) td{
-    background: #fafbfa;
-    }
-
-    /* last row border */
-    table.records-table tbody tr:last-child td{
-    border-bottom: none;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-
-    # ✅ Build styled HTML table
-    styled = (
-        view.style
-        .hide(axis="index")
-        .set_table_attributes('class="records-table"')
-    )
+    # ✅ Build HTML table (styling comes from APP_CSS)
+    table_html = view.to_html(classes="records-table", index=False, border=0)
 
-    st.markdown(f"<div class='records-wrap'>{styled.to_html()}</div>", unsafe_allow_html=True)
+    st.markdown(f"<div class='records-wrap'>{table_html}</div>", unsafe_allow_html=True)
 
 
 
@@ -717,3 +933,7 @@ elif page == "Dataset":
 
 elif page == "About":
     render_about_page()
+
+# Start loading and warming the model once per process; runs on the
+# batcher's worker thread, so this returns immediately
+get_batcher()